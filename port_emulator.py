@@ -1,9 +1,9 @@
-import time
 import serial
 import serial.threaded
 import threading
+import collections
+import queue
 import logging
-import time
 
 import clr
 clr.AddReference('MTBApi, Version=2.12.0.7, Culture=neutral, PublicKeyToken=39820acb30580488')
@@ -17,9 +17,23 @@ from System import Array, Char
 
 logger = logging.getLogger(__name__)
 
+CAN29_MESSAGE_TYPE = CZCANSRVLib.CZCom_MessageType.CZCom_MessageType_CAN29
+
+# Framing of CAN29 messages on the COM port
+CAN29_MESSAGE_START = b'\x10\x02'
+CAN29_MESSAGE_END = b'\x10\x03'
+
 
 def bytearray_to_str(barray):
-    return ' '.join(map(hex, barray))
+    return barray.hex(' ')
+
+
+def str_to_bytearray(string: str):
+    try:
+        return bytearray.fromhex(string)
+    except ValueError:
+        # Fall back to tokens which are not exactly two hex digits, e.g. '0x1'
+        return bytearray(map(lambda _: int(_, 16), string.split()))
 
 
 class CANCommunication:
@@ -34,186 +48,350 @@ class CANCommunication:
     Unfortunately, there is no easy way to access the port from Python directly, precluding MTB style events on
     received messages. We hence use the monitoring capabilities of CZCANSRVLib to subscribe to all received CAN
     bus messages.
+
+    The received messages are put into a bounded queue and are fetched with receive_messages(). This way, the
+    monitor event handler never blocks on the consumer. If the queue is full, the oldest message is dropped.
     """
-    def __init__(self, msg_cb_fun):
+    def __init__(self, max_queued_messages=1024):
         self._conn = MTBAPI.MTBConnection()
         self._login_id = self._conn.Login('en', '')
         self._root = self._conn.GetRoot(self._login_id)
         self._d = self._root.GetDeviceFullConfig(0)
 
-        # Get all the devices of this device
-        # This is required for the workaround where the CAN29 enumeration command does not work for simulated
-        # hardware.
-        devices = [(can_id, self._d.FindComponentByCanID(can_id)) for can_id in range(255)]
-        logger.info("Found the following devices via MTB")
-        for can_id, device_type in devices:
-            if not device_type:
-                continue
-            logger.info(f'{can_id: 4d}\t{device_type}')
+        # Cached for send_message(), avoids resolving them again for every message
+        self._send = self._d.SendMessage
+        self._char_array = Array[Char]
+        self._extra_data_buffer = array.array('B')
 
-        self._device_ids = tuple([can_id for can_id, device in devices if device])
+        # Looked up on first access, see device_ids
+        self._device_ids = None
 
         # Register a monitor to get the replies on the CAN level
         # FIXME: This registers to all ports and does not differentiate between them.
         self._monitor = CZCANSRVLib.MonitorClass()
         self._monitor.MonitorMode = CZCANSRVLib.CZCom_MonitorMode.CZCom_MonitorMode_AllRawData_ASCII
+        self._received_msgs = queue.Queue(maxsize=max_queued_messages)
+        self._dropped_msgs = 0           # Only written by the monitor event handler
+        self._reported_dropped_msgs = 0  # Only written by receive_messages()
         self._monitor.MonitorASCII += self.m_Monitor_MonitorASCII
-        self._msg_cb_fun = msg_cb_fun
 
     @property
     def device_ids(self):
+        """
+        CAN ids of all devices known to MTB.
+
+        This is required for the workaround where the CAN29 enumeration command does not work for simulated
+        hardware. Since querying them takes 255 calls into MTB, they are only looked up when first needed, which
+        is only the case for simulated hardware.
+        """
+        if self._device_ids is None:
+            devices = [(can_id, self._d.FindComponentByCanID(can_id)) for can_id in range(255)]
+            logger.info("Found the following devices via MTB")
+            for can_id, device_type in devices:
+                if not device_type:
+                    continue
+                logger.info('% 4d\t%s', can_id, device_type)
+
+            self._device_ids = tuple([can_id for can_id, device in devices if device])
+
         return self._device_ids
 
-    def __del__(self):
+    def close(self):
+        """
+        Stop monitoring the CAN bus and log out of MTB.
+        """
+        if self._monitor is None:
+            return
+
         self._monitor.MonitorASCII -= self.m_Monitor_MonitorASCII
+        self._monitor = None
+        self._conn.Logout(self._login_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def m_Monitor_MonitorASCII(self, mon_mode, port_nr, err_state, text:str):
         # FIXME: Check for correct port_nr
         if not err_state and '<-' in text:
-            msg = bytearray(map(lambda _: int(_, 16), text.split('<-')[-1].split()))
-            if self._msg_cb_fun:
-                self._msg_cb_fun(msg)
+            msg = str_to_bytearray(text.rsplit('<-', 1)[-1])
+            while True:
+                try:
+                    self._received_msgs.put_nowait(msg)
+                    break
+                except queue.Full:
+                    # Reported by receive_messages(), logging here would stall the monitor
+                    self._dropped_msgs += 1
+                    try:
+                        self._received_msgs.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def receive_messages(self, timeout=None):
+        """
+        Wait for received CAN messages and return all messages which are queued.
+
+        Returns an empty list if no message has been received within timeout seconds.
+        """
+        dropped_msgs = self._dropped_msgs
+        if dropped_msgs != self._reported_dropped_msgs:
+            logger.warning("Receive queue was full, dropped %d messages",
+                           dropped_msgs - self._reported_dropped_msgs)
+            self._reported_dropped_msgs = dropped_msgs
+
+        try:
+            messages = [self._received_msgs.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+
+        while True:
+            try:
+                messages.append(self._received_msgs.get_nowait())
+            except queue.Empty:
+                return messages
 
     def send_message(self, destination_addr, source_addr, cmd_class, cmd_number, sub_nr, proc_id, extra_data=None):
         if extra_data:
-            x = array.array('B', extra_data)
-            extra_data = Array[Char](x)
+            x = self._extra_data_buffer
+            del x[:]
+            try:
+                x.frombytes(extra_data)  # Single copy for buffers, unlike extend()
+            except TypeError:
+                x.extend(extra_data)     # Any other sequence of ints
+            extra_data = self._char_array(x)
         else:
             extra_data = ''
 
-        self._d.SendMessage(CZCANSRVLib.CZCom_MessageType.CZCom_MessageType_CAN29,
-                            destination_addr, source_addr, cmd_class, cmd_number, sub_nr, proc_id, extra_data)
+        self._send(CAN29_MESSAGE_TYPE, destination_addr, source_addr, cmd_class, cmd_number, sub_nr, proc_id,
+                   extra_data)
 
-    def send_raw(self, bytes: bytearray):
-        assert bytes[2] == len(bytes) - 5, "Length field of the sent raw string is wrong."
+    def send_raw(self, raw: bytearray):
+        if raw[2] != len(raw) - 5:
+            raise ValueError(f"Length field of the sent raw string is wrong: {raw[2]} instead of {len(raw) - 5}.")
         self.send_message(
-            destination_addr=bytes[0],
-            source_addr=bytes[1],
-            cmd_class=bytes[3],
-            cmd_number=bytes[4],
-            proc_id=bytes[5],
-            sub_nr=bytes[6],
-            extra_data=bytes[7:] if len(bytes) > 6 else None
+            destination_addr=raw[0],
+            source_addr=raw[1],
+            cmd_class=raw[3],
+            cmd_number=raw[4],
+            proc_id=raw[5],
+            sub_nr=raw[6],
+            extra_data=memoryview(raw)[7:] if len(raw) > 7 else None  # No copy, send_message copies it in bulk
         )
 
     def send_str(self, string: str):
-        self.send_raw(bytearray(map(lambda _: int(_, 16), string.split())))
+        self.send_raw(str_to_bytearray(string))
+
+
+def encode_can29_message_into(out: bytearray, raw_message: bytearray):
+    """
+    Append the encoded raw_message to out.
+    """
+    # The second replace never matches the 0x10 bytes inserted by the first one
+    out += CAN29_MESSAGE_START
+    out += bytes(raw_message).replace(b'\x10', b'\x10\x10').replace(b'\x0d', b'\x10\x0d')
+    out += CAN29_MESSAGE_END
 
 
 def encode_can29_message(raw_message: bytearray):
-    escaped_msg = bytearray([0x10, 0x02])
-    for c in raw_message:
-        if c in [0x10, 0x0d]:
-            escaped_msg.append(0x10)
-        escaped_msg.append(c)
-    escaped_msg.extend([0x10, 0x03])
+    escaped_msg = bytearray()
+    encode_can29_message_into(escaped_msg, raw_message)
     return escaped_msg
 
 
 class Can29SerialReceiverProtocol(serial.threaded.Protocol):
     """
     Receive native Zeiss CAN29 messages on a COM port.
+
+    The reader thread only appends the received chunks to a deque, which does not require any locking. The chunks
+    are then parsed incrementally by the consumer: the parser state is kept between calls, such that every received
+    byte is only looked at once.
     """
 
+    # Trim the consumed part of the input buffer only once it exceeds this size
+    _TRIM_THRESHOLD = 4096
+
     def __init__(self):
         super().__init__()
-        self._input_buffer = bytearray()
-        self._lock = threading.Lock()
+        self._chunks = collections.deque()  # Received, but not yet parsed data
+        self._input_buffer = bytearray()     # Only accessed by the consumer
+        self._wakeup = threading.Event()      # Set whenever new data has been received
+
+        # Parser state
+        self._scan_pos = 0          # Position in the input buffer up to which the data has been parsed
+        self._escape_found = False  # Whether the last parsed byte was an (unpaired) 0x10
+        self._message = None        # Partially received message, None when outside of a message
 
     def data_received(self, data):
-        with self._lock:
-            self._input_buffer.extend(data)
+        self._chunks.append(bytes(data))
+        self._wakeup.set()
+
+    def wait_for_data(self, timeout=None):
+        """
+        Wait until data has been received since the last call, or until timeout seconds have passed.
+        """
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        while True:
-            ten_found = False
-            message_data = None
-
-            with self._lock:
-                for i, c in enumerate(self._input_buffer):
-                    if ten_found:
-                        ten_found = False
-
-                        if c == 0x02:
-                            message_data = bytearray()
-                            continue
-
-                        if c == 0x03:
-                            self._input_buffer = self._input_buffer[i+1:]
+        chunks = self._chunks
+        while chunks:
+            self._input_buffer.extend(chunks.popleft())
+
+        message_data = self._parse_input_buffer()
+
+        if self._scan_pos > self._TRIM_THRESHOLD:
+            del self._input_buffer[:self._scan_pos]
+            self._scan_pos = 0
+
+        if message_data is None:
+            raise StopIteration("No mode current messages in buffer")
+
+        return message_data
+
+    def _parse_input_buffer(self):
+        """
+        Continue parsing the input buffer and return the next complete message, or None if there is none yet.
+        """
+        buf = self._input_buffer
+        end = len(buf)
+        pos = self._scan_pos
+
+        with memoryview(buf) as buf_view:
+            while pos < end:
+                if self._escape_found:
+                    self._escape_found = False
+                    c = buf[pos]
+                    pos += 1
+
+                    if c == 0x02:
+                        self._message = bytearray()
+                        continue
 
-                            if message_data is not None:
-                                return message_data
+                    if c == 0x03:
+                        message_data, self._message = self._message, None
+                        if message_data is not None:
+                            self._scan_pos = pos
+                            return message_data
+                        continue
 
-                        if c in [0x0d, 0x10]:
-                            if message_data is not None:
-                                message_data.append(c)
-                            continue
+                    if c in (0x0d, 0x10):
+                        if self._message is not None:
+                            self._message.append(c)
+                        continue
 
-                        raise RuntimeError(f"Got an unexpected character {hex(c)} following a 0x10 character.")
+                    self._scan_pos = pos
+                    raise RuntimeError(f"Got an unexpected character {hex(c)} following a 0x10 character.")
 
-                    if c == 0x10:
-                        ten_found = True
-                        continue
+                # Copy everything up to the next 0x10 character in one go
+                next_pos = buf.find(b'\x10', pos)
+                if next_pos < 0:
+                    next_pos = end
+                else:
+                    self._escape_found = True
 
-                    if message_data is not None:
-                        message_data.append(c)
+                if self._message is not None:
+                    self._message.extend(buf_view[pos:next_pos])
+                pos = next_pos + 1 if self._escape_found else next_pos
 
-            if message_data is None:
-                raise StopIteration("No mode current messages in buffer")
+        self._scan_pos = pos
+        return None
 
 
 def start_can_forwarder(serial_port: str):
     ser = serial.Serial(serial_port, baudrate=57600, timeout=1)
     rt = serial.threaded.ReaderThread(ser, Can29SerialReceiverProtocol)
-    with rt as can_input_protocol:
-        def msg_cb_fun(raw_message: bytearray):
-            print(f'< {bytearray_to_str(raw_message)}')
-            rt.write(bytes(raw_message))
-            with can_input_protocol._lock:
-                can_input_protocol.serial.flushOutput()
-
-
-        zeiss_can_port = CANCommunication(msg_cb_fun)
+    with rt as can_input_protocol, CANCommunication() as zeiss_can_port:
+        stop_forwarding = threading.Event()
+
+        def forward_can_messages():
+            try:
+                # Write all messages received meanwhile with a single write
+                while not stop_forwarding.is_set():
+                    raw_messages = zeiss_can_port.receive_messages(timeout=0.5)
+                    if not raw_messages:
+                        continue
 
-        while True:
-            # Read in all current messages in the COM port input buffer
-            for raw_message in can_input_protocol:
-                print(f'> {bytearray_to_str(raw_message)}')
-
-                # Unfortunately, the simulation does not include a full enumeration of the
-                # CAN devices attached to a target.
-                #
-                # We hence fake a reply, claiming that all devices provided by MTB exist.
-                if zeiss_can_port._d.Simulated and raw_message[3] == 0x15 and raw_message[4] == 0xa0 and raw_message[6] == 0xfe:
-                    print('Fake reply!')
-                    logger.debug("Faking an enumeration ")
-
-                    dev_ids = zeiss_can_port.device_ids
-                    for i, dev_id in enumerate(dev_ids):
+                    if logger.isEnabledFor(logging.DEBUG):
+                        for raw_message in raw_messages:
+                            logger.debug('< %s', bytearray_to_str(raw_message))
+                    # No flush required, write() only returns once the data has been passed to the driver. Note
+                    # that flushOutput() would discard pending output instead of draining it.
+                    rt.write(b''.join(raw_messages))
+            except Exception:
+                logger.exception("Forwarding CAN messages to the serial port failed")
+
+        forwarder = threading.Thread(target=forward_can_messages, name='CAN forwarder')
+        forwarder.start()
+
+        try:
+            # Does not change while running, avoids going through the CLR for every message
+            is_simulated = bool(zeiss_can_port._d.Simulated)
+
+            # The device ids are needed to fake the enumeration for simulated hardware. Look them up before serving
+            # the port, such that the first enumeration request of a client does not time out.
+            dev_ids = zeiss_can_port.device_ids if is_simulated else ()
+
+            # Avoid the attribute lookups for every message
+            write = rt.write
+            send_raw = zeiss_can_port.send_raw
+
+            while True:
+                can_input_protocol.wait_for_data(timeout=1.0)
+
+                if not forwarder.is_alive():
+                    raise RuntimeError("Forwarding CAN messages to the serial port failed")
+
+                # Read in all current messages in the COM port input buffer
+                for raw_message in can_input_protocol:
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug('> %s', bytearray_to_str(raw_message))
+
+                    # Unfortunately, the simulation does not include a full enumeration of the
+                    # CAN devices attached to a target.
+                    #
+                    # We hence fake a reply, claiming that all devices provided by MTB exist.
+                    if is_simulated and raw_message[3] == 0x15 and raw_message[4] == 0xa0 and raw_message[6] == 0xfe:
+                        logger.debug("Faking an enumeration ")
+
+                        # Only the multi-response flag and the device id differ between the replies
                         reply = bytearray([
                             raw_message[1],  # Reply to code
                             raw_message[0],  # Device id which responds
                             0x04,            # Message length
-                            0x09 if (i + 1 == len(dev_ids)) else 0x05,  # Multi-response anwser
+                            0x05,            # Multi-response anwser, 0x09 for the last reply
                             raw_message[4],  # Find devices
                             raw_message[5],  # ProcID
                             raw_message[6],  # Subid
-                            dev_id,
+                            0x00,            # Device id
                             3                # FIXME: Unknown what to send here.
                         ])
 
-                        print('<f', bytearray_to_str(reply))
-                        rt.write(encode_can29_message(reply))
+                        # Send all replies with a single write
+                        out = bytearray()
+                        last_i = len(dev_ids) - 1
+                        for i, dev_id in enumerate(dev_ids):
+                            reply[3] = 0x09 if i == last_i else 0x05
+                            reply[7] = dev_id
 
-                    # Do not forward the message to the real Can device
-                    continue
+                            if logger.isEnabledFor(logging.DEBUG):
+                                logger.debug('<f %s', bytearray_to_str(reply))
+                            encode_can29_message_into(out, reply)
 
-                zeiss_can_port.send_raw(raw_message)
+                        write(bytes(out))
+
+                        # Do not forward the message to the real Can device
+                        continue
 
-            time.sleep(0.01)
+                    send_raw(raw_message)
+        finally:
+            # Stop writing to the serial port before it and the CAN connection are closed
+            stop_forwarding.set()
+            forwarder.join()
 
 
 def main():